@@ -1,5 +1,6 @@
 __author__ = 'Guillaume'
 
+import cv2
 import numpy as np
 from PIL import Image
 from fuel.datasets.dogs_vs_cats import DogsVsCats
@@ -44,36 +45,56 @@ class Dataset(object):
         self.next_batch()
         return self.current_batch
 
+def load_channel_first(dataset, indices, chunk_size=500):
+    """
+    Read the rows 'indices' of a (N, rows, cols, channels) dataset (typically memory-mapped) into a channel first
+    (len(indices), channels, rows, cols) array. Rows are read and transposed by chunks, so that the whole set is
+    never held twice in memory.
+    """
+    out = np.empty((len(indices), dataset.shape[3], dataset.shape[1], dataset.shape[2]), dtype=dataset.dtype)
+    for start in range(0, len(indices), chunk_size):
+        s = slice(start, start+chunk_size)
+        out[s] = dataset[indices[s]].transpose(0,3,1,2)
+    return out
+
 class InMemoryDataset(Dataset):
-    def __init__(self, mode, source, batch_size=1, source_targets=None, shuffle=True, division="leaderboard"):
+    def __init__(self, mode, source, batch_size=1, source_targets=None, shuffle=True, division="leaderboard",
+                 channel_first=False):
         self.mode = mode
+        self.division = division
+        self.channel_first = channel_first
         super( InMemoryDataset, self).__init__(source, batch_size, source_targets, shuffle)
         self.offset = 0
         self.index = np.arange(0,self.dataset.shape[0],1)
         self.iterator = 0
-        self.division = division
         self.on_new_epoch()
 
     def load_dataset(self, source):
-        dataset = np.load(source)
+        # Memory-mapped : only the rows of the requested set are read from the disk
+        dataset = np.load(source, mmap_mode="r")
+        if self.channel_first:
+            return load_channel_first(dataset, self.get_set_indices())
+        return dataset[self.get_set_indices()]
+
+    def get_set_indices(self):
         if self.division == "leaderboard":
             index_train, index_valid = dataset_division_leaderboard()
             index_test = index_valid
         else:
             index_train, index_valid, index_test = dataset_division()
         if self.mode == "train":
-            return dataset[index_train]
+            return index_train
         if self.mode == "valid":
-            return dataset[index_valid]
+            return index_valid
         if self.mode == "test":
-            return dataset[index_test]
+            return index_test
         else:
             raise Exception("Mode not understood. Use : train, valid or test. Here : %s"%self.mode)
 
     def load_targets(self, source_targets):
         if source_targets is None:
             raise Exception("source_targets not defined.")
-        return self.load_dataset(source_targets)
+        return np.load(source_targets, mmap_mode="r")[self.get_set_indices()]
 
     def on_new_epoch(self):
         if self.shuffle:
@@ -93,6 +114,73 @@ class InMemoryDataset(Dataset):
 
 
 
+class JpegDataset(InMemoryDataset):
+    """
+    Same as InMemoryDataset, but images are read from a packed JPEG file (see pack_dataset_as_jpeg) instead of a
+    numpy file. Only the encoded bytes are kept (memory-mapped), images are decoded when a batch is requested.
+    Targets are still read from a numpy file.
+    """
+    def load_dataset(self, source):
+        return PackedJpegImages(source, self.get_set_indices())
+
+class PackedJpegImages(object):
+    """
+    Array-like access to a packed JPEG file : images[indices] returns the decoded images as a
+    (len(indices), rows, cols, channels) uint8 array.
+    """
+    def __init__(self, source, indices):
+        self.bytes = np.memmap(source, dtype="uint8", mode="r")
+        index = np.load(source+".index.npz")
+        self.offsets = index["offsets"]
+        self.indices = indices
+        self.shape = (indices.shape[0],) + tuple(int(d) for d in index["shape"][1:])
+        if self.shape[3] == 1:
+            self.flag = cv2.IMREAD_GRAYSCALE
+        else:
+            self.flag = cv2.IMREAD_COLOR
+
+    def decode(self, i):
+        img = cv2.imdecode(np.asarray(self.bytes[self.offsets[i]:self.offsets[i+1]]), self.flag)
+        if self.shape[3] == 1:
+            return img[:,:,None]
+        return img[:,:,::-1] # BGR -> RGB
+
+    def __getitem__(self, indices):
+        indices = self.indices[indices]
+        if indices.ndim == 0:
+            return self.decode(indices)
+        from preprocessing import get_processing_pool # avoid a circular import
+        out = np.empty((indices.shape[0],)+self.shape[1:], "uint8")
+        def decode_sample(k):
+            out[k] = self.decode(indices[k])
+        # cv2.imdecode releases the GIL : images are decoded in parallel
+        get_processing_pool().map(decode_sample, range(indices.shape[0]))
+        return out
+
+def pack_dataset_as_jpeg(dataset_path, path_out, quality=95):
+    """
+    Convert a numpy dataset of shape (N, rows, cols, channels) into a packed JPEG file readable by JpegDataset.
+    Encoded images are concatenated in path_out, their offsets and the dataset shape are stored in
+    path_out + '.index.npz'.
+
+    :param dataset_path: numpy file saved using numpy.save
+    :param path_out: where to write the packed file
+    :param quality: JPEG quality, from 0 to 100
+    """
+    dataset = np.load(dataset_path, mmap_mode="r")
+    offsets = np.zeros(dataset.shape[0]+1, "int64")
+    with open(path_out, "wb") as f:
+        for i in range(dataset.shape[0]):
+            img = np.asarray(dataset[i], "uint8")
+            if img.shape[2] == 3:
+                img = img[:,:,::-1] # RGB -> BGR
+            ok, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise Exception("JPEG encoding failed for image %d."%i)
+            f.write(encoded.tobytes())
+            offsets[i+1] = offsets[i] + encoded.shape[0]
+    np.savez(path_out+".index.npz", offsets=offsets, shape=np.array(dataset.shape))
+
 class FuelDataset(Dataset):
     def __init__(self, mode, tmp_size, source="image_features", batch_size=1, bagging=1, bagging_iterator=0,
                  source_targets=None, shuffle=True, division="leaderboard", N=None):
@@ -169,14 +257,18 @@ class FuelDataset(Dataset):
         else:
             self.current_batch = (batch, targets)
 
-    def return_whole_dataset(self):
+    def return_whole_dataset(self, channel_first=False):
         self.on_new_epoch()
         for i, batch in enumerate(self.iterator):
+            if channel_first: # Fuel images are already (channel, rows, cols)
+                images = np.array(batch[0])
+            else:
+                images = np.concatenate([b.transpose(1,2,0)[None,:,:] for b in batch[0]])
             if i == 0:
-                dataset = np.concatenate([b.transpose(1,2,0)[None,:,:] for b in batch[0]])
+                dataset = images
                 targets = batch[1]
             else:
-                dataset = np.concatenate((dataset,np.concatenate([b.transpose(1,2,0)[None,:,:] for b in batch[0]])))
+                dataset = np.concatenate((dataset,images))
                 targets = np.concatenate((targets,batch[1]))
         return dataset, targets
 
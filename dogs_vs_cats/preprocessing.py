@@ -1,35 +1,40 @@
 __author__ = 'Guillaume'
 
-#import cv2 # OpenCV
+import cv2 # OpenCV
+import inspect
 import matplotlib.pyplot as plt
 import numpy as np
 import PIL
 import time
-from dataset import InMemoryDataset, FuelDataset
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from numba import njit
+from dataset import InMemoryDataset, JpegDataset, FuelDataset
 from scipy.ndimage.filters import gaussian_filter
 from keras.models import model_from_json
+import keras.backend as K
 
-def remove_black_borders_from_rotation(rotated_img, angle):
-
-    if angle<0:
-        out = remove_black_borders_from_rotation(rotated_img[:,::-1], -angle)
-        return out[:,::-1]
-
-    row, col = rotated_img.shape[0:2]
+cv2.setNumThreads(cv2.getNumberOfCPUs()) # Set to 0 once the processing pool is used, see get_processing_pool
 
-    first_row = rotated_img[0]
-    first_col = rotated_img[:,0]
+GENERATOR_QUEUE_SIZE = 10 # Maximum number of batches queued by the keras function 'fit_generator'
 
-    try:
-        cropx = np.argwhere(np.cumsum(first_row[::-1]!=0)==1)[0][0]
-        cropy = np.argwhere(np.cumsum(first_col!=0)==1)[0][0]
-    except:
-        cropx=0.2*row
-        cropy=0.2*col
+processing_pool = None # Threads used to preprocess the samples of a batch in parallel, see get_processing_pool
 
-    if cropy>(0.4*row) or cropx>(0.4*col):
-        return rotated_img
+def get_processing_pool():
+    """
+    Return the thread pool used to preprocess the samples of a batch. OpenCV and the numba kernels release the GIL,
+    so the samples are really processed in parallel. The pool is created at the first call.
+    """
+    global processing_pool
+    if processing_pool is None:
+        processing_pool = ThreadPool(cpu_count())
+        # Images are already processed in parallel by the pool : multi-threaded OpenCV calls would oversubscribe the CPU
+        cv2.setNumThreads(0)
+    return processing_pool
 
+def remove_black_borders_from_rotation(rotated_img, angle):
+    row, col = rotated_img.shape[0:2]
+    cropy, cropx = get_rotation_crop(row, col, angle)
     return rotated_img[cropy:(row-cropy), cropx:(col-cropx)]
 
 def remove_black_borders_from_translation(translated_img, tx, ty):
@@ -43,12 +48,32 @@ def remove_black_borders_from_translation(translated_img, tx, ty):
 
     return translated_img[up:down, left:right]
 
+def largest_rotated_rect(rows, cols, angle):
+    """
+    Size of the largest axis-aligned rectangle which fits inside a (rows, cols) image rotated by 'angle' degrees.
+
+    :return: (height, width) of the rectangle
+    """
+    a = np.abs(np.sin(np.radians(angle)))
+    b = np.abs(np.cos(np.radians(angle)))
+    side_long, side_short = max(rows, cols), min(rows, cols)
+    if side_short <= 2.0*a*b*side_long or np.abs(a-b) < 1e-10:
+        # Half constrained case : two corners of the rectangle touch the longest side
+        x = 0.5*side_short
+        if cols >= rows:
+            return x/b, x/a
+        return x/a, x/b
+    return (rows*b - cols*a)/(b*b - a*a), (cols*b - rows*a)/(b*b - a*a)
+
+def get_rotation_crop(rows, cols, angle):
+    # Number of rows and cols to remove on each side of a rotated image to get rid of the black borders
+    height, width = largest_rotated_rect(rows, cols, angle)
+    return int(np.ceil((rows-height)/2.0)), int(np.ceil((cols-width)/2.0))
+
 def rotate(img, angle):
-    if img.ndim == 3 and img.shape[2]==1:
-        pil_img = PIL.Image.fromarray(img[:,:,0])
-    else:
-        pil_img = PIL.Image.fromarray(img)
-    return np.array(pil_img.rotate(angle), dtype=img.dtype).reshape(img.shape)
+    rows, cols = img.shape[0:2]
+    M = cv2.getRotationMatrix2D((cols/2.0, rows/2.0), angle, 1.0)
+    return cv2.warpAffine(img, M, (cols, rows), flags=cv2.INTER_CUBIC).reshape(img.shape)
 
 def resize_pil(img, size, interpolation = PIL.Image.BICUBIC):
     if img.ndim == 3 and img.shape[2]==1:
@@ -58,18 +83,38 @@ def resize_pil(img, size, interpolation = PIL.Image.BICUBIC):
         pil_img = PIL.Image.fromarray(img)
         return np.array(pil_img.resize(size, interpolation), dtype=img.dtype)
 
-# def resize_cv2(img, size, interpolation = cv2.INTER_CUBIC):
-#     if img.ndim == 2:
-#         return cv2.resize(img, size, interpolation = interpolation)
-#     else:
-#         if img.shape[2] == 3:
-#             return cv2.resize(img, size, interpolation = interpolation)
-#         else:
-#             return cv2.resize(img, size, interpolation = interpolation)[:,:,None]
+def resize(img, size, interpolation = cv2.INTER_CUBIC):
+    out = cv2.resize(img, size, interpolation = interpolation)
+    # cv2 drops the channel axis of single channel images
+    return out[:,:,None] if img.ndim == 3 and img.shape[2] == 1 else out
+
+def resize_dataset(dataset, final_size):
+    """
+    Resize every image of a (N, rows, cols, channels) dataset. Images are processed in parallel by the threads of
+    the processing pool (cv2.resize releases the GIL), and written channel first.
+
+    :param dataset: images to resize
+    :param final_size: (rows, cols, channels)
+    :return: float32 array of shape (N, final_size[2], final_size[0], final_size[1])
+    """
+    out = np.empty((dataset.shape[0], final_size[2], final_size[0], final_size[1]), dtype="float32")
+    # Area interpolation when downscaling, bicubic when upscaling
+    if final_size[0] < dataset.shape[1]:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_CUBIC
+    def resize_image(i):
+        out[i] = resize(dataset[i], (final_size[1], final_size[0]), interpolation).transpose(2,0,1)
+    get_processing_pool().map(resize_image, range(dataset.shape[0]))
+    return out
+
+def scale_dataset(dataset, scale):
+    # Conversion to float32 and scaling in a single pass
+    return np.multiply(dataset, np.float32(1.0/scale), dtype="float32")
 
 def resize_and_scale(img, size, scale, interpolation = PIL.Image.BICUBIC):
     img = resize_pil(img, size, interpolation)
-    return np.array(img, "float32")/scale
+    return scale_dataset(img, scale)
 
 # def translate(img, tx, ty):
 #     if img.ndim > 2:
@@ -84,14 +129,52 @@ def add_channel(img):
 def convert_to_grayscale(img):
     return PIL.Image.fromarray(img).convert("L")
 
-def crop(img, crop_rates):
-    rows,cols = img.shape[0:2]
+def get_crop_box(rows, cols, crop_rates):
+    # Returns the (up, down, left, right) bounds of the crop
     crop_up, crop_down, crop_left, crop_right = crop_rates
     crop_up = int(crop_up*rows/100.0)
     crop_down = int(crop_down*rows/100.0)
     crop_left = int(crop_left*rows/100.0)
     crop_right = int(crop_right*rows/100.0)
-    return img[crop_up:(rows-crop_down),crop_left:(cols-crop_right)]
+    return crop_up, rows-crop_down, crop_left, cols-crop_right
+
+def crop(img, crop_rates):
+    rows,cols = img.shape[0:2]
+    up, down, left, right = get_crop_box(rows, cols, crop_rates)
+    return img[up:down,left:right]
+
+def get_transformation_matrix(shape, final_size, angle, crop_rates, flip):
+    """
+    Compose rotation, black borders removal, crop, resize and flip into a single 2x3 affine matrix, so that one
+    cv2.warpAffine call replaces the whole rotate->crop->resize->fliplr chain.
+
+    :param shape: shape of the source image
+    :param final_size: (width, height) of the output image
+    :param angle: rotation angle in degrees
+    :param crop_rates: (up, down, left, right) crop rates in percent
+    :param flip: if True, the output is flipped left right
+    :return: 2x3 float matrix mapping source coordinates to output coordinates
+    """
+    rows, cols = shape[0:2]
+    # Rotation around the center
+    R = np.eye(3)
+    R[0:2] = cv2.getRotationMatrix2D((cols/2.0, rows/2.0), angle, 1.0)
+    # Black borders removal, then random crop
+    cropy, cropx = get_rotation_crop(rows, cols, angle)
+    up, down, left, right = get_crop_box(rows-2*cropy, cols-2*cropx, crop_rates)
+    x0, y0 = cropx+left, cropy+up
+    # Resize of the cropped area (same pixel centers convention as cv2.resize)
+    sx = float(final_size[0])/(right-left)
+    sy = float(final_size[1])/(down-up)
+    S = np.array([[sx, 0, (0.5-x0)*sx-0.5],
+                  [0, sy, (0.5-y0)*sy-0.5],
+                  [0, 0, 1]])
+    M = np.dot(S, R)
+    # Flip left right
+    if flip:
+        M[0] = -M[0]
+        M[0,2] += final_size[0]-1
+    return M[0:2]
 
 def rotate_and_crop(img, max_angle, max_crop_rate):
     # Random Rotation
@@ -104,57 +187,125 @@ def rotate_and_crop(img, max_angle, max_crop_rate):
     cropped_im = crop(cropped_rotated_img, crop_rates)
     return cropped_im
 
+def make_warp_scale_transpose(channels):
+    """
+    Build the fused rotate/crop/resize/flip/scale/transpose kernel specialized for a number of channels. 'channels' is
+    a compile-time constant for numba, so the channel loop is unrolled (removed for grayscale images).
+    The kernel is compiled once at import for uint8 images, and cached on the disk for the next runs.
+    """
+    @njit("void(uint8[:,:,:], float32[:,:,::1], float32[:,::1], float32)", nogil=True, fastmath=True, cache=True,
+          boundscheck=False)
+    def warp_scale_transpose(src, dst, Minv, scale):
+        """
+        Bilinear sampling of a (rows, cols, channels) image through the inverse affine matrix Minv, written directly
+        into a (channels, height, width) float32 array.
+
+        :param src: source image (rows, cols, channels)
+        :param dst: destination (channels, height, width), typically a slice of the batch array
+        :param Minv: 2x3 matrix mapping destination coordinates to source coordinates
+        :param scale: output values are divided by scale
+        """
+        rows, cols = src.shape[0], src.shape[1]
+        height, width = dst.shape[1], dst.shape[2]
+        for y in range(height):
+            for x in range(width):
+                sx = min(max(Minv[0,0]*x + Minv[0,1]*y + Minv[0,2], 0.0), cols-1.0)
+                sy = min(max(Minv[1,0]*x + Minv[1,1]*y + Minv[1,2], 0.0), rows-1.0)
+                x0 = int(sx)
+                y0 = int(sy)
+                x1 = min(x0+1, cols-1)
+                y1 = min(y0+1, rows-1)
+                ax = sx - x0
+                ay = sy - y0
+                for c in range(channels):
+                    top = src[y0,x0,c]*(1.0-ax) + src[y0,x1,c]*ax
+                    bottom = src[y1,x0,c]*(1.0-ax) + src[y1,x1,c]*ax
+                    dst[c,y,x] = (top*(1.0-ay) + bottom*ay)/scale
+    return warp_scale_transpose
+
+# Fused kernels, indexed by the number of channels
+warp_scale_transpose_kernels = {1: make_warp_scale_transpose(1),
+                                3: make_warp_scale_transpose(3)}
+
+def draw_random_transformations(n, max_angle, max_crop_rate):
+    """
+    Draw the random rotations, crops and flips of n images at once.
+
+    :return: list of n (angle, crop_rates, flip) tuples
+    """
+    angles = np.random.randint(-max_angle, max_angle, n)
+    crop_rates = np.random.randint(0, max_crop_rate, (n,4))
+    flips = np.random.randint(0, 2, n)==1
+    return list(zip(angles, crop_rates, flips))
+
+def random_transformation_matrix(shape, final_size, max_angle, max_crop_rate, transformation=None):
+    """
+    Return the inverse 2x3 matrix (mapping output coordinates to source coordinates) of a random rotation, crop and
+    flip, as used by warp and warp_scale_transpose. The transformation is drawn if not given
+    (see draw_random_transformations).
+    """
+    if transformation is None:
+        transformation = draw_random_transformations(1, max_angle, max_crop_rate)[0]
+    angle, crop_rates, flip = transformation
+    M = get_transformation_matrix(shape, final_size, angle, crop_rates, flip)
+    return np.array(cv2.invertAffineTransform(M), "float32")
+
+def warp(img, Minv, final_size):
+    # Rotate, crop, resize and flip in one pass. Bilinear with replicated borders, like the warp_scale_transpose
+    # kernels, so that every path of rotate_crop_and_scale produces the same images.
+    out = cv2.warpAffine(img, Minv, tuple(final_size), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                         borderMode=cv2.BORDER_REPLICATE)
+    return out.reshape(out.shape[0:2]+img.shape[2:])
+
 def rotate_crop_and_scale(img, final_size, max_angle, max_crop_rate, scale, blur=None,
-                          rgb_alterate=False):
-    cropped_im=rotate_and_crop(img, max_angle, max_crop_rate)
-    # Resize and scale
-    resized_img = resize_and_scale(cropped_im, final_size, scale, interpolation=PIL.Image.BICUBIC)
-    # Flip left right
+                          rgb_alterate=False, out=None, transformation=None):
+    Minv = random_transformation_matrix(img.shape, final_size, max_angle, max_crop_rate, transformation)
+    if out is not None and blur is None and not rgb_alterate and img.dtype == np.uint8:
+        # Single pass over the pixels, directly into the (channels, rows, cols) output
+        warp_scale_transpose_kernels[img.shape[2]](img, out, Minv, np.float32(scale))
+        return out
+    resized_img = scale_dataset(warp(img, Minv, final_size), scale)
     if rgb_alterate:
         resized_img = rgb_alteration(resized_img)
     if blur is not None:
         resized_img = gaussian_filter(resized_img, blur)
-    if np.random.randint(0,2)==1:
-        resized_img = np.fliplr(resized_img)
-    #output_img = resized_img[None,:,:]
     # Return
-    return resized_img
+    return write_output(resized_img, out)
+
+def write_output(img, out):
+    # Copy a (rows, cols, channels) image into the (channels, rows, cols) out array, if given
+    if out is None:
+        return img
+    out[...] = img.transpose(2,0,1)
+    return out
 
 def rotate_crop_and_standardize(img, final_size, max_angle, max_crop_rate, blur=None, eps=1e-3,
-                                rgb_alterate=False):
-    cropped_im=rotate_and_crop(img, max_angle, max_crop_rate)
-    # Resize and scale
-    resized_img = resize_pil(cropped_im, final_size, interpolation=PIL.Image.BICUBIC)
+                                rgb_alterate=False, out=None, transformation=None):
+    Minv = random_transformation_matrix(img.shape, final_size, max_angle, max_crop_rate, transformation)
+    resized_img = warp(img, Minv, final_size)
     if rgb_alterate:
         resized_img = rgb_alteration(resized_img)
     if blur is not None:
         resized_img = gaussian_filter(resized_img, blur)
     resized_img = (resized_img - resized_img.mean())/(resized_img.std()+eps)
-    # Flip left right
-    if np.random.randint(0,2)==1:
-        resized_img = np.fliplr(resized_img)
     # Return
-    return resized_img
+    return write_output(resized_img, out)
 
 def rotate_crop_and_mean(img, final_size, max_angle, max_crop_rate, blur=None,
-                         rgb_alterate=False):
-    cropped_im=rotate_and_crop(img, max_angle, max_crop_rate)
-    # Resize and scale
-    resized_img = resize_pil(cropped_im, final_size, interpolation=PIL.Image.BICUBIC)
+                         rgb_alterate=False, out=None, transformation=None):
+    Minv = random_transformation_matrix(img.shape, final_size, max_angle, max_crop_rate, transformation)
+    resized_img = warp(img, Minv, final_size)
     if rgb_alterate:
         resized_img = rgb_alteration(resized_img)
     if blur is not None:
         resized_img = gaussian_filter(resized_img, blur)
     resized_img = resized_img - resized_img.mean()
-    # Flip left right
-    if np.random.randint(0,2)==1:
-        resized_img = np.fliplr(resized_img)
     # Return
-    return resized_img
+    return write_output(resized_img, out)
 
 def preprocess_dataset(dataset, training_params, mode):
     if mode == "scale":
-        dataset = dataset / training_params.scale
+        dataset = scale_dataset(dataset, training_params.scale)
     if mode == "std":
         dataset = standardize_dataset(dataset, [1,2,3])
     if mode == "mean":
@@ -165,6 +316,37 @@ def preprocess_dataset(dataset, training_params, mode):
 
     return dataset
 
+def preprocess_dataset_on_gpu(dataset, training_params, modes, batch_size, eps=1e-3):
+    """
+    Apply preprocess_dataset for each mode of 'modes', but with a compiled Keras function : the 'scale', 'std' and
+    'mean' operations are done on the GPU, batch by batch. Falls back on preprocess_dataset if 'blur' is requested.
+
+    :param dataset: (N, channel, rows, cols) array
+    :return: float32 preprocessed dataset
+    """
+    if "blur" in modes:
+        for mode in modes:
+            dataset = preprocess_dataset(dataset, training_params, mode)
+        return dataset
+    # Define the preprocessing graph
+    x = K.placeholder(ndim=4)
+    y = x
+    for mode in modes:
+        if mode == "scale":
+            y = y / training_params.scale
+        if mode == "std":
+            m = K.mean(y, axis=[1,2,3], keepdims=True)
+            std = K.sqrt(K.mean(K.square(y-m), axis=[1,2,3], keepdims=True)) + eps
+            y = (y-m)/std
+        if mode == "mean":
+            y = y - K.mean(y, axis=[1,2,3], keepdims=True)
+    preprocess = K.function([x], [y])
+    # Process the dataset batch by batch
+    out = np.empty(dataset.shape, "float32")
+    for i in range(0, dataset.shape[0], batch_size):
+        out[i:(i+batch_size)] = preprocess([dataset[i:(i+batch_size)]])[0]
+    return out
+
 def rgb_alteration(im):
     rgb_components = np.array([[-0.57070609,-0.58842455,-0.57275746],
                                [ 0.72758705,-0.03900872,-0.68490539],
@@ -184,10 +366,11 @@ def convert_labels(labels_1D):
     :param labels_1D: [1,0,1,0,0...]
     :return: [[1,0],[0,1]...]
     """
-    targets = np.zeros((len(labels_1D),2))
-    targets[:,0] = labels_1D.flatten()
-    targets[:,1] = 1-labels_1D.flatten()
-    return np.array(targets, "float32")
+    labels = np.ravel(labels_1D)
+    targets = np.empty((labels.shape[0],2), "float32")
+    targets[:,0] = labels
+    np.subtract(1, labels, out=targets[:,1], casting="unsafe")
+    return targets
 
 def mean_with_list_axis(a, ax):
     out = np.mean(a, axis=ax[-1])
@@ -213,27 +396,54 @@ def remove_mean_dataset(dataset, ax=[1,2,3], eps=1e-3):
     broadcast_m = m.reshape(shape)
     return dataset-broadcast_m
 
-def get_next_batch(dataset, batch_size, final_size, preprocessing_func, preprocessing_args):
+def allocate_batch_buffers(batch_size, final_size, n=1):
+    return [np.empty((batch_size,final_size[2],final_size[0],final_size[1]), dtype="float32") for i in range(n)]
+
+def preprocess_sample(img, preprocessing_func, func_args, preprocessing_args, out, transformation=None):
+    """
+    Apply preprocessing_func to one image, the result being written in out (channels, rows, cols). The keywords 'out'
+    and 'transformation' are only given to the functions accepting them (func_args, the names of their arguments) :
+    other functions must return the processed image (rows, cols, channels).
+    """
+    kwargs = {}
+    if transformation is not None and "transformation" in func_args:
+        kwargs["transformation"] = transformation
+    if "out" in func_args:
+        preprocessing_func(img, *preprocessing_args, out=out, **kwargs)
+    else:
+        out[...] = preprocessing_func(img, *preprocessing_args, **kwargs).transpose(2,0,1)
+
+def get_next_batch(dataset, batch_size, final_size, preprocessing_func, preprocessing_args, out=None):
     # Get next batch
     batch,batch_targets = dataset.get_batch()
-    # Pre-processing
-    processed_batch = np.zeros((batch.shape[0],final_size[2],final_size[0],final_size[1]),
-                                   dtype="float32")
-    for k in range(batch_size):
-        processed_batch[k] = preprocessing_func(batch[k], *preprocessing_args).transpose(2,0,1)
+    # Pre-processing, in place if out is given
+    if out is None:
+        out = allocate_batch_buffers(batch.shape[0], final_size)[0]
+    func_args = inspect.getargspec(preprocessing_func).args
+    if "transformation" in func_args:
+        # Random transformations of the whole batch, drawn at once
+        named_args = dict(zip(func_args[1:], preprocessing_args))
+        transformations = draw_random_transformations(batch_size, named_args["max_angle"],
+                                                      named_args["max_crop_rate"])
+    else:
+        transformations = [None]*batch_size
+    def process_sample(k):
+        preprocess_sample(batch[k], preprocessing_func, func_args, preprocessing_args, out[k], transformations[k])
+    get_processing_pool().map(process_sample, range(batch_size))
     # Convert labels
     labels = convert_labels(batch_targets)
-    return processed_batch, labels
+    return out, labels
 
 def images_generator(data_access, dataset, targets, batch_size, tmp_size, final_size, bagging_size, bagging_iterator,
                      multiple_input, division, preprocessing_func, preprocessing_args):
     """
-    Generator function used when using the keras function 'fit_on_generator'. Can work with InMemoryDataset, FuelDataset.
+    Generator function used when using the keras function 'fit_on_generator'. Can work with InMemoryDataset, JpegDataset,
+    FuelDataset.
     Yield a tuple to the training containing a processed batch and
     targets. This can be done on the CPU, in parallel of a GPU training. See 'fit_on_generator' for more details.
 
-    :param data_access: "in-memory" or "fuel"
-    :param dataset: path to the dataset numpy file (not used when data_acces = "fuel")
+    :param data_access: "in-memory", "jpeg" or "fuel"
+    :param dataset: path to the dataset numpy file, or packed JPEG file (not used when data_acces = "fuel")
     :param targets: path to the targets numpy file (not used when data_acces = "fuel")
     :param batch_size:
     :param tmp_size: Used when data_access == "fuel". Datastream will return images of size equal to tmp_size.
@@ -245,14 +455,23 @@ def images_generator(data_access, dataset, targets, batch_size, tmp_size, final_
     if data_access=="in-memory":
         train_dataset = InMemoryDataset("train", source=dataset, batch_size=batch_size, source_targets=targets,
                                         division=division)
+    elif data_access=="jpeg":
+        train_dataset = JpegDataset("train", source=dataset, batch_size=batch_size, source_targets=targets,
+                                    division=division)
     elif data_access=="fuel":
         train_dataset = FuelDataset("train", tmp_size, batch_size=batch_size, bagging=bagging_size,
                                     bagging_iterator=bagging_iterator, division=division)
     else:
-        raise Exception("Data access not available. Must be 'fuel' or 'in-memory'. Here : %s."%data_access)
+        raise Exception("Data access not available. Must be 'fuel', 'in-memory' or 'jpeg'. Here : %s."%data_access)
+    # Batches are written in buffers allocated once. fit_generator queues up to GENERATOR_QUEUE_SIZE batches, so
+    # enough buffers are needed to never overwrite a batch which has not been used yet.
+    buffers = allocate_batch_buffers(batch_size, final_size, GENERATOR_QUEUE_SIZE+2)
+    n_batches = 0
     while 1:
         # Get next batch
-        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func, preprocessing_args)
+        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func,
+                                                 preprocessing_args, out=buffers[n_batches%len(buffers)])
+        n_batches += 1
         if multiple_input == 1:
             yield processed_batch,labels
         else:
@@ -263,15 +482,20 @@ def features_generator(data_access, dataset, targets, batch_size, tmp_size, fina
     # Instantiate the dataset
     if data_access=="in-memory":
         train_dataset = InMemoryDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
+    elif data_access=="jpeg":
+        train_dataset = JpegDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
     elif data_access=="fuel":
         train_dataset = FuelDataset("train", tmp_size, batch_size=batch_size, bagging=bagging_size,
                                     bagging_iterator=bagging_iterator)
     else:
-        raise Exception("Data access not available. Must be 'fuel' or 'in-memory'. Here : %s."%data_access)
+        raise Exception("Data access not available. Must be 'fuel', 'in-memory' or 'jpeg'. Here : %s."%data_access)
+    # Batch buffer allocated once : the batch is consumed by the pretrained model before the next one is computed
+    buffer = allocate_batch_buffers(batch_size, final_size)[0]
     # Generator loop
     while 1:
         # Get next batch
-        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func, preprocessing_args)
+        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func,
+                                                 preprocessing_args, out=buffer)
         if multiple_input == 1:
             features = pretrained_model.predict(processed_batch)
             yield features, labels
@@ -284,15 +508,20 @@ def multi_features_generator(data_access, dataset, targets, batch_size, tmp_size
     # Instantiate the dataset
     if data_access=="in-memory":
         train_dataset = InMemoryDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
+    elif data_access=="jpeg":
+        train_dataset = JpegDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
     elif data_access=="fuel":
         train_dataset = FuelDataset("train", tmp_size, batch_size=batch_size, bagging=bagging_size,
                                     bagging_iterator=bagging_iterator)
     else:
-        raise Exception("Data access not available. Must be 'fuel' or 'in-memory'. Here : %s."%data_access)
+        raise Exception("Data access not available. Must be 'fuel', 'in-memory' or 'jpeg'. Here : %s."%data_access)
+    # Batch buffer allocated once : the batch is consumed by the pretrained model before the next one is computed
+    buffer = allocate_batch_buffers(batch_size, final_size)[0]
     # Generator loop
     while 1:
         # Get next batch
-        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func, preprocessing_args)
+        processed_batch, labels = get_next_batch(train_dataset, batch_size, final_size, preprocessing_func,
+                                                 preprocessing_args, out=buffer)
         if multiple_input == 1:
             features = []
             for pretrained_model in pretrained_models:
@@ -308,10 +537,12 @@ def check_preprocessed_data(data_access, dataset, targets, batch_size, tmp_size,
                             preprocessing_args, n=10):
     if data_access=="in-memory":
         train_dataset = InMemoryDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
+    elif data_access=="jpeg":
+        train_dataset = JpegDataset("train", source=dataset, batch_size=batch_size, source_targets=targets)
     elif data_access=="fuel":
         train_dataset = FuelDataset("test", tmp_size, batch_size=batch_size, division="leaderboard", shuffle=False)
     else:
-        raise Exception("Data access not available. Must be 'fuel' or 'in-memory'. Here : %s."%data_access)
+        raise Exception("Data access not available. Must be 'fuel', 'in-memory' or 'jpeg'. Here : %s."%data_access)
 
     # Compute only one batch
     start=time.time()
@@ -319,8 +550,9 @@ def check_preprocessed_data(data_access, dataset, targets, batch_size, tmp_size,
     batch_targets = convert_labels(batch_targets)
     processed_batch = np.zeros((batch.shape[0],final_size[2],final_size[0],final_size[1]),
                                    dtype="float32")
+    func_args = inspect.getargspec(preprocessing_func).args
     for k in range(batch_size):
-        processed_batch[k] = preprocessing_func(batch[k], *preprocessing_args).transpose(2,0,1)
+        preprocess_sample(batch[k], preprocessing_func, func_args, preprocessing_args, processed_batch[k])
     end=time.time()
 
     print "Batch Shape = ", processed_batch.shape, "with dtype =", processed_batch.dtype
@@ -330,7 +562,7 @@ def check_preprocessed_data(data_access, dataset, targets, batch_size, tmp_size,
         plt.gray()
         plt.clf()
         plt.title("(%d,%d)"%(batch_targets[i][0], batch_targets[i][1]))
-        if batch.shape[1]==3:
+        if processed_batch.shape[1]==3:
             plt.imshow(processed_batch[i].transpose(1,2,0))
         else:
             plt.imshow(processed_batch[i,0])
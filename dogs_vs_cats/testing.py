@@ -9,7 +9,7 @@ import os
 import pickle
 from scipy.ndimage.filters import gaussian_filter
 from dataset import InMemoryDataset, FuelDataset
-from preprocessing import standardize_dataset, convert_labels, preprocess_dataset
+from preprocessing import standardize_dataset, convert_labels, preprocess_dataset, scale_dataset
 
 def categorical_crossentropy(ytrue, ypred, eps=1e-6):
     return -np.mean((ytrue*np.log(ypred+eps)).sum(axis=1))
@@ -36,7 +36,7 @@ def update_BN_params(model, dataset, scale=1.0, N=100, verbose=False):
         if verbose:
             print "\rProcessing batch %d..."%(i),
         # Get next batch
-        batch = dataset.get_batch()[0]/scale
+        batch = scale_dataset(dataset.get_batch()[0], scale)
         out = intermediate_outputs([batch.transpose(0,3,1,2)])
         for i,maps in enumerate(out):
             if maps.ndim == 4:
@@ -196,7 +196,7 @@ def predict(model, dataset, training_params, flip, verbose=True):
         batch,targets= dataset.get_batch()
         # Eventually flip
         if flip:
-            batch = np.fliplr(batch.transpose(1,2,3,0)).transpose(3,0,1,2)
+            batch = batch[:,:,::-1] # view, materialized by the float32 conversion below
         # Preprocess
         for mode in training_params.valid_preprocessing:
             batch = preprocess_dataset(batch, training_params, mode)
@@ -387,7 +387,7 @@ def get_features(model, dataset, position, N, training_params, verbose, flip=Fal
         batch,targets= dataset.get_batch()
         # Eventually flip
         if flip:
-            batch = np.fliplr(batch.transpose(1,2,3,0)).transpose(3,0,1,2)
+            batch = batch[:,:,::-1] # view, materialized by the float32 conversion below
         # Preprocess
         for mode in training_params.valid_preprocessing:
             batch = preprocess_dataset(batch, training_params, mode)
@@ -10,37 +10,44 @@ import sys
 from contextlib import contextmanager
 from keras.callbacks import Callback, EarlyStopping
 import keras.backend as K
-from preprocessing import resize_pil, check_preprocessed_data, convert_labels, standardize_dataset, preprocess_dataset, \
-    get_next_batch
+from preprocessing import resize_dataset, check_preprocessed_data, convert_labels, standardize_dataset, preprocess_dataset, \
+    preprocess_dataset_on_gpu, get_next_batch, allocate_batch_buffers
 from reporting import write_experiment_report, print_architecture
 from training_params import TrainingParams
-from dataset import InMemoryDataset, FuelDataset
+from dataset import InMemoryDataset, JpegDataset, FuelDataset
 from testing import get_best_model_from_exp, test_model, update_BN_params, generate_submission_file, \
     adapt_to_new_input, categorical_crossentropy, predict, test_ensemble_of_models, test_model_on_exp, generate_csv_file
 
-def save_history(path, history):
+def save_history(path, history, validation=None):
     """
     Save the loss, validation loss, accuracy and validation accuracy of a Keras training into a pickle file.
 
     :param path: where to save the pickle file
     :param history: an History object returned by the fit function of Keras
+    :param validation: ValidationOnDevice callback used for the training, if any : the validation loss and accuracy
+    are then taken from it, since they are not in the History object
     :return:
     """
+    if validation is not None:
+        val_loss, val_acc = validation.val_loss, validation.val_acc
+    else:
+        val_loss, val_acc = history.history["val_loss"], history.history["val_acc"]
     with open(path,"w") as f:
         pickle.dump(history.history["loss"],f)
-        pickle.dump(history.history["val_loss"],f)
+        pickle.dump(val_loss,f)
         pickle.dump(history.history["acc"],f)
-        pickle.dump(history.history["val_acc"],f)
+        pickle.dump(val_acc,f)
 
 class ModelCheckpoint_perso(Callback):
     """
-    Keras callback subclass which defines a saving procedure of the model being trained : after each epoch,
-    the last model is saved under the name 'after_random.cnn'. The best model is saved with the name 'best_model.cnn'.
-    The model after random can also be saved. And the model architecture is saved with the name 'config.network'.
+    Keras callback subclass which defines a saving procedure of the model being trained : every 'save_every' epochs,
+    the last model is saved under the name 'last_epoch.cnn'. The best weights are kept in memory, and saved with the
+    name 'best_model.cnn' at the end of the training. The model after random can also be saved. And the model
+    architecture is saved with the name 'config.network'.
     Everything is stored using pickle.
     """
     def __init__(self, filepath, monitor='val_acc', verbose=1, save_best_only=False, save_first=True, optional_string="",
-                 mode="acc"):
+                 mode="acc", save_every=1):
         super(Callback, self).__init__()
         self.monitor = monitor
         self.verbose = verbose
@@ -49,6 +56,8 @@ class ModelCheckpoint_perso(Callback):
         self.save_first = save_first
         self.optional_string = optional_string
         self.mode = mode
+        self.save_every = save_every
+        self.best_weights = None
         if mode == "acc":
             self.best = -np.Inf
         elif mode == "loss":
@@ -71,7 +80,7 @@ class ModelCheckpoint_perso(Callback):
                 f.write("***\nEpoch %05d: %s after random  model saved to %s\n"%(epoch, self.monitor, save_path))
                 f.close()
             if self.save_first:
-                self.model.save_weights(save_path, overwrite=True)
+                save_weights(self.model, save_path)
 
     def on_epoch_end(self, epoch, logs={}):
         # SAVING WEIGHTS
@@ -81,19 +90,80 @@ class ModelCheckpoint_perso(Callback):
         else:
             condition = current < self.best
         if condition:
-            save_path = self.filepath+"/best_model.cnn"
             if self.verbose > 0:
                 string = "***\nEpoch %05d: %s improved from %0.5f to %0.5f\n"% (epoch, self.monitor, self.best, current)
                 write_log(self.filepath+"/log.txt", string)
             self.best = current
-            self.model.save_weights(save_path, overwrite=True)
+            # Kept in memory, written at the end of the training
+            self.best_weights = self.model.get_weights()
 
         else:
             save_path = self.filepath+"/last_epoch.cnn"
             if self.verbose > 0:
                 string = "***\nEpoch %05d: %s did not improve : %0.5f\n"% (epoch, self.monitor, current)
                 write_log(self.filepath+"/log.txt", string)
-            self.model.save_weights(save_path, overwrite=True)
+            if (epoch+1) % self.save_every == 0:
+                save_weights(self.model, save_path)
+
+    def on_train_end(self, logs={}):
+        if self.best_weights is None:
+            return
+        last_weights = self.model.get_weights()
+        self.model.set_weights(self.best_weights)
+        save_weights(self.model, self.filepath+"/best_model.cnn")
+        self.model.set_weights(last_weights)
+
+class ValidationOnDevice(Callback):
+    """
+    Keras callback which computes the validation loss and accuracy at the end of each epoch, and adds them to the logs
+    as 'val_loss' and 'val_acc'. The validation set is stored once in the GPU memory (shared variable), instead of
+    being transferred at each epoch when given as 'validation_data' to fit_generator. The same callback can be
+    reused for several trainings. It must be placed before the callbacks using 'val_loss' or 'val_acc'.
+    The History callback of fit_generator reads the logs before this callback : the values of the last training are
+    kept in val_loss and val_acc instead (see save_history). Relies on the 'givens' argument of the theano backend.
+    """
+    def __init__(self, validset, valid_targets, batch_size, verbose=1):
+        super(ValidationOnDevice, self).__init__()
+        self.validset = K.variable(validset)
+        self.valid_targets = valid_targets
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.predict = None
+        self.val_loss = []
+        self.val_acc = []
+
+    def on_train_begin(self, logs={}):
+        self.val_loss = []
+        self.val_acc = []
+        # Prediction function reading its input batch from the shared validset
+        index = K.placeholder(ndim=0, dtype="int32")
+        batch = self.validset[index*self.batch_size:(index+1)*self.batch_size]
+        self.predict = K.function([index], [self.model.layers[-1].get_output(train=False)],
+                                  givens={self.model.layers[0].input: batch})
+
+    def on_epoch_end(self, epoch, logs={}):
+        N = int(np.ceil(self.valid_targets.shape[0]/float(self.batch_size)))
+        preds = np.concatenate([self.predict([i])[0] for i in range(N)])
+        logs["val_loss"] = categorical_crossentropy(self.valid_targets, preds)
+        logs["val_acc"] = np.mean(np.argmax(self.valid_targets, axis=1) == np.argmax(preds, axis=1))
+        self.val_loss.append(logs["val_loss"])
+        self.val_acc.append(logs["val_acc"])
+        if self.verbose > 0:
+            print "Epoch %05d: val_loss = %0.5f, val_acc = %0.5f"%(epoch, logs["val_loss"], logs["val_acc"])
+
+def save_weights(model, path):
+    """
+    Save the weights of a Keras model in a temporary file first, then rename it : an interrupted saving never leaves
+    a corrupted file at 'path'.
+
+    :param model: Keras model
+    :param path: where to save the weights
+    """
+    tmp_path = path + ".tmp"
+    model.save_weights(tmp_path, overwrite=True)
+    if platform.system()=="Windows" and os.path.exists(path): # os.rename does not overwrite on Windows
+        os.remove(path)
+    os.rename(tmp_path, path)
 
 def write_log(path, string):
     """
@@ -102,16 +172,8 @@ def write_log(path, string):
     :param path: textfile location
     :param string: line to add
     """
-    # Open and Read
-    f = open(path, "r")
-    lines = f.readlines()
-    f.close()
-    # Adding a line
-    lines.append(string)
-    # Write
-    f = open(path, "w")
-    f.writelines(lines)
-    f.close()
+    with open(path, "a") as f:
+        f.write(string)
 
 @contextmanager
 def timer(name):
@@ -130,30 +192,44 @@ def timer(name):
 
 def load_dataset_in_memory_and_resize(data_access, set, division, dataset_path, targets_path, tmp_size,
                                       final_size, batch_size):
+    """
+    Load a whole set in memory, eventually resized to final_size.
+
+    :return: (dataset, targets), the dataset being channel first (N, channel, rows, cols) like the model inputs
+    """
     if data_access == "in-memory":
         with timer("Loading %s data"%set):
-            dataset = InMemoryDataset(set, dataset_path, source_targets=targets_path, division=division)
-            draw_data = np.copy(dataset.dataset)
-            targets = np.copy(dataset.targets)
+            dataset = InMemoryDataset(set, dataset_path, source_targets=targets_path, division=division,
+                                      channel_first=(tmp_size == final_size))
+            draw_data, targets = dataset.dataset, dataset.targets
+            del dataset
+        if tmp_size == final_size:
+            return draw_data, targets
+    elif data_access == "jpeg":
+        with timer("Loading %s data"%set):
+            dataset = JpegDataset(set, dataset_path, source_targets=targets_path, division=division)
+            draw_data = dataset.dataset[np.arange(dataset.dataset.shape[0])]
+            targets = dataset.targets
             del dataset
     elif data_access == "fuel":
         with timer("Loading %s data"%set):
             dataset = FuelDataset(set, tmp_size, batch_size=batch_size, shuffle=False, division=division)
-            draw_data,targets = dataset.return_whole_dataset()
+            draw_data,targets = dataset.return_whole_dataset(channel_first=(tmp_size == final_size))
             del dataset
+        if tmp_size == final_size:
+            return draw_data, targets
     else:
-        raise Exception("Data access not available. Must be 'fuel' or 'in-memory'. Here : %s."%data_access)
+        raise Exception("Data access not available. Must be 'fuel', 'in-memory' or 'jpeg'. Here : %s."%data_access)
 
     if tmp_size != final_size:
         # Resize images from the validset
-        out = np.zeros((draw_data.shape[0], final_size[0], final_size[1], final_size[2]), dtype="float32")
         with timer("Resizing %s images"%set):
-            for i in range(draw_data.shape[0]):
-                out[i] = resize_pil(draw_data[i], final_size[0:2])
+            out = resize_dataset(draw_data, final_size)
         del draw_data
         return out, targets
     else:
-        return draw_data, targets
+        # Convert once to the channel first layout
+        return np.ascontiguousarray(draw_data.transpose(0,3,1,2)), targets
 
 def launch_training(training_params):
     """
@@ -173,10 +249,8 @@ def launch_training(training_params):
     valid_targets = convert_labels(valid_targets)
 
     ###### Preprocessing VALIDATION DATA #######
-    for mode in training_params.valid_preprocessing:
-        validset = preprocess_dataset(validset, training_params, mode)
-    # Transpose validset >> (N, channel, X, Y)
-    validset = validset.transpose(0,3,1,2)
+    validset = preprocess_dataset_on_gpu(validset, training_params, training_params.valid_preprocessing,
+                                         training_params.test_batch_size)
     # Multiple input ?
     if training_params.multiple_inputs>1:
         validset = [validset for i in range(training_params.multiple_inputs)]
@@ -207,6 +281,18 @@ def launch_training(training_params):
     # Print architecture
     print_architecture(model, path_out=training_params.path_out + "/architecture.txt")
 
+    ###### VALIDATION ON DEVICE ######
+    # The validset is copied once in the GPU memory, and shared by every training of the loop
+    # 'givens' is only supported by the theano backend
+    if training_params.valid_on_device and training_params.multiple_inputs == 1 and K._BACKEND == "theano":
+        validation = ValidationOnDevice(validset, valid_targets, training_params.test_batch_size)
+        validation_data = None
+        callbacks = [validation]
+    else:
+        validation = None
+        validation_data = (validset,  valid_targets)
+        callbacks = []
+
     ###### TRAINING LOOP #######
     count = training_params.fine_tuning
 
@@ -219,19 +305,20 @@ def launch_training(training_params):
             # Callbacks
             early_stoping = EarlyStopping(monitor="val_loss",patience=training_params.max_no_best)
             save_model = ModelCheckpoint_perso(filepath=training_params.path_out+"/MEM_%d"%count, verbose=1,
-                                               optional_string=s, monitor="val_acc", mode="acc")
+                                               optional_string=s, monitor="val_acc", mode="acc",
+                                               save_every=training_params.save_every)
 
             history = model.fit_generator(training_params.generator(*training_params.generator_args),
                                           nb_epoch=training_params.nb_max_epoch,
                                           samples_per_epoch= int(training_params.Ntrain*training_params.bagging_size),
                                           show_accuracy=True,
                                           verbose=training_params.verbose,
-                                          validation_data=(validset,  valid_targets),
-                                          callbacks=[early_stoping, save_model])
+                                          validation_data=validation_data,
+                                          callbacks=callbacks+[early_stoping, save_model])
 
             training_params.learning_rate *= 0.1
             training_params.update_model_args()
-            save_history(training_params.path_out+"/MEM_%d/history.pkl"%count, history)
+            save_history(training_params.path_out+"/MEM_%d/history.pkl"%count, history, validation)
             count += 1
 
 def launch_adversarial_training(training_params):
@@ -251,10 +338,8 @@ def launch_adversarial_training(training_params):
     valid_targets = convert_labels(valid_targets)
 
     ###### Preprocessing VALIDATION DATA #######
-    for mode in training_params.valid_preprocessing:
-        validset = preprocess_dataset(validset, training_params, mode)
-    # Transpose validset >> (N, channel, X, Y)
-    validset = validset.transpose(0,3,1,2)
+    validset = preprocess_dataset_on_gpu(validset, training_params, training_params.valid_preprocessing,
+                                         training_params.test_batch_size)
     # Multiple input ?
     if training_params.multiple_inputs>1:
         validset = [validset for i in range(training_params.multiple_inputs)]
@@ -291,6 +376,7 @@ def launch_adversarial_training(training_params):
                                 batch_size=training_params.batch_size,
                                 bagging=training_params.bagging_size,
                                 bagging_iterator=training_params.bagging_iterator)
+    batch_buffer = allocate_batch_buffers(training_params.batch_size, training_params.final_size)[0]
 
     ###### ADVERSARIAL MAPPING ######
 
@@ -355,7 +441,8 @@ def launch_adversarial_training(training_params):
                     processed_batch, labels = get_next_batch(train_dataset, training_params.batch_size,
                                                              training_params.final_size,
                                                              training_params.preprocessing_func,
-                                                             training_params.preprocessing_args)
+                                                             training_params.preprocessing_args,
+                                                             out=batch_buffer)
                     l, acc = model.train_on_batch(processed_batch, labels, accuracy=True)
                     # Update stats
                     if new:
@@ -404,7 +491,7 @@ def launch_adversarial_training(training_params):
                         print string
                         write_log(path+"/log.txt", string)
                     best = score
-                    model.save_weights(save_path, overwrite=True)
+                    save_weights(model, save_path)
                 else:
                     no_best_count += 1
                     save_path = path+"/last_epoch.cnn"
@@ -412,7 +499,7 @@ def launch_adversarial_training(training_params):
                         string = string + "\n"
                         print string
                         write_log(path+"/log.txt", string)
-                    model.save_weights(save_path, overwrite=True)
+                    save_weights(model, save_path)
                 epoch_count += 1
 
             # Update learning rate
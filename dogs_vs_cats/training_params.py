@@ -20,6 +20,7 @@ class TrainingParams():
         self.nb_max_epoch = 1000
         self.verbose = 2
         self.batch_size = 32
+        self.save_every = 1 # the last model is saved every 'save_every' epochs
         # Data processing
         self.Ntrain = 22500 # Only used to set the nb of examples per epoch in the fit_generator function
         self.Nvalid = 2500 # Not used
@@ -38,8 +39,8 @@ class TrainingParams():
         self.division = "leaderboard" # 'leaderboard' to use the dataset split proposed on the leaderboard page
         if platform.system()=="Linux":
             self.data_access = "fuel"
-        self.dataset_path = "path_to_numpy_file" # only used if data_access = 'in-memory'
-        self.targets_path = "path_to_numpy_file" # only used if data_access = 'in-memory'
+        self.dataset_path = "path_to_numpy_file" # only used if data_access = 'in-memory' or 'jpeg' (packed JPEG file)
+        self.targets_path = "path_to_numpy_file" # only used if data_access = 'in-memory' or 'jpeg'
         self.multiple_inputs = 1
         self.preprocessing_func = rotate_crop_and_scale
         self.preprocessing_args = [self.final_size[0:2], self.max_rotation, self.max_crop_rate, self.scale, self.blur,
@@ -66,6 +67,7 @@ class TrainingParams():
         # Testing parameters
         self.test_sizes = [(270,270,3), (210,210,3), (150,150,3)]
         self.test_batch_size = 50
+        self.valid_on_device = True # keep the validset in the GPU memory during the training (not with multiple inputs)
         # self.ensemble_models = ["experiments/blog_post_5_scale_invariant/vggnet_with_BN_RGB_window_46_v2_512",
         #                         "experiments/blog_post_5_scale_invariant/vggnet_with_BN_RGB_window_100_v2"]
         self.ensemble_models = [self.path_out]
@@ -108,7 +110,7 @@ class TrainingParams():
             except:
                 args += "???, "
         s += "\n\t with args : %s"%args
-        if self.data_access=="in-memory":
+        if self.data_access=="in-memory" or self.data_access=="jpeg":
             s += "\n\t Dataset : %s"%self.dataset_path
             s += "\n\t Targets : %s"%self.targets_path
         else:
@@ -119,6 +121,7 @@ class TrainingParams():
         s += "\n\t Momentum : %.5f"%(self.momentum)
         s += "\n\t Early stopping patience : %d"%(self.max_no_best)
         s += "\n\t Batch Size : %d"%(self.batch_size)
+        s += "\n\t Save last model every : %d epochs"%(self.save_every)
         s += "\n\nOther :"
         s += "\n\t Multiple Training : %d"%(self.multiple_training)
         s += "\n\t Fine-tuning : %d"%(self.fine_tuning)